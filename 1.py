@@ -1,13 +1,7 @@
-from pymongo import MongoClient
-
-def get_db():
-    client = MongoClient("mongodb://localhost:27017/")
-    db = client["ecotrack"]
-    return db
+from db_connect import get_db
 
 # Test
 if __name__ == "__main__":
     db = get_db()
     print("Connected!")
     print("Collections:", db.list_collection_names())
-
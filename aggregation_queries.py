@@ -2,119 +2,156 @@
 #  aggregation_queries.py
 #  This file contains all MongoDB Aggregation Pipelines
 #  for your EcoTrack project.
+#
+#  Sections 1–6 only cover the reporting window, which
+#  defaults to 2024 and can be passed as dates:
+#      python aggregation_queries.py 2024-01-01 2024-06-30
 # -----------------------------------------------------
 
+import sys
+from datetime import datetime, timedelta
 from db_connect import get_db
+from refresh_rollups import ROLLUP_COLLECTION
 
 # Connect to database
 db = get_db()
 
+# Reporting window — every raw-telemetry pipeline starts with this $match so the
+# vt_ts_aid_v index prefix (value_type, timestamp) is used
+def report_date(pos, default):
+    return datetime.strptime(sys.argv[pos], "%Y-%m-%d") if len(sys.argv) > pos else default
+
+REPORT_START = report_date(1, datetime(2024, 1, 1))
+REPORT_END = report_date(2, datetime(2024, 12, 31)) + timedelta(days=1, seconds=-1)   # end date is inclusive
+WINDOW = f"[{REPORT_START:%Y-%m-%d} .. {REPORT_END:%Y-%m-%d}]"
+print("Reporting window:", WINDOW)
+
+# Large cursor batches so result sets come back in few getMore round trips;
+# results are printed straight off the cursor rather than collected in a list
+BATCH_SIZE = 5000
+
+match_electricity = {"$match": {
+    "value_type": "electricity_kWh",
+    "timestamp": {"$gte": REPORT_START, "$lte": REPORT_END}
+}}
+
 
 # -----------------------------------------------------
 # 1️⃣ TOTAL ELECTRICITY CONSUMPTION
 # -----------------------------------------------------
-print("\n1️⃣ Total Electricity Consumption (kWh):")
+print(f"\n1️⃣ Total Electricity Consumption (kWh) {WINDOW}:")
 
 pipeline_total = [
-    {"$match": {"value_type": "electricity_kWh"}},     # Filter only electricity readings
+    match_electricity,                                 # Filter only electricity readings
     {"$group": {
         "_id": None,
         "total_kWh": {"$sum": "$value"}               # Sum all values
     }}
 ]
 
-result_total = list(db.telemetry.aggregate(pipeline_total))
-print(result_total)
+for doc in db.telemetry.aggregate(pipeline_total, batchSize=BATCH_SIZE):
+    print(doc)
 
 
 
 # -----------------------------------------------------
 # 2️⃣ ELECTRICITY USAGE PER ASSET (PER MACHINE)
 # -----------------------------------------------------
-print("\n2️⃣ Electricity Usage Per Asset:")
+print(f"\n2️⃣ Electricity Usage Per Asset {WINDOW}:")
 
 pipeline_asset = [
-    {"$match": {"value_type": "electricity_kWh"}},
+    match_electricity,
     {"$group": {
         "_id": "$asset_id",                           # Group by each machine
         "total_kWh": {"$sum": "$value"}
     }}
 ]
 
-result_asset = list(db.telemetry.aggregate(pipeline_asset))
-print(result_asset)
+for doc in db.telemetry.aggregate(pipeline_asset, batchSize=BATCH_SIZE, allowDiskUse=True):
+    print(doc)
 
 
 
 # -----------------------------------------------------
 # 3️⃣ AVERAGE ELECTRICITY USAGE
 # -----------------------------------------------------
-print("\n3️⃣ Average Electricity Usage (kWh):")
+print(f"\n3️⃣ Average Electricity Usage (kWh) {WINDOW}:")
 
 pipeline_avg = [
-    {"$match": {"value_type": "electricity_kWh"}},
+    match_electricity,
     {"$group": {
         "_id": None,
         "average_kWh": {"$avg": "$value"}             # Calculate average
     }}
 ]
 
-result_avg = list(db.telemetry.aggregate(pipeline_avg))
-print(result_avg)
+for doc in db.telemetry.aggregate(pipeline_avg, batchSize=BATCH_SIZE):
+    print(doc)
 
 
 
 # -----------------------------------------------------
 # 4️⃣ DAILY ELECTRICITY USAGE
 # -----------------------------------------------------
-print("\n4️⃣ Electricity Usage Per Day:")
+print(f"\n4️⃣ Electricity Usage Per Day {WINDOW}:")
 
 pipeline_daily = [
-    {"$match": {"value_type": "electricity_kWh"}},
+    match_electricity,
     {"$group": {
-        "_id": {"$substr": ["$timestamp", 0, 10]},    # Extract date from timestamp
+        "_id": {"$dateTrunc": {"date": "$timestamp", "unit": "day"}},  # Truncate timestamp to its day
         "daily_kWh": {"$sum": "$value"}               # Sum values per date
     }},
     {"$sort": {"_id": 1}}                             # Sort by date
 ]
 
-result_daily = list(db.telemetry.aggregate(pipeline_daily))
-print(result_daily)
+for doc in db.telemetry.aggregate(pipeline_daily, batchSize=BATCH_SIZE, allowDiskUse=True):
+    print(doc)
 
 
 
 # -----------------------------------------------------
 # 5️⃣ HIGHEST ELECTRICITY SPIKE (MAX USAGE)
 # -----------------------------------------------------
-print("\n5️⃣ Highest Electricity Spike:")
+print(f"\n5️⃣ Highest Electricity Spike {WINDOW}:")
 
-pipeline_spike = [
-    {"$match": {"value_type": "electricity_kWh"}},
-    {"$sort": {"value": -1}},                         # Sort highest first
-    {"$limit": 1}                                     # Take only top 1
-]
+# find + sort + limit walks the (value_type, value desc) index from the top
+# and stops at the first key, instead of sorting every match in $sort
+cursor_spike = (
+    db.telemetry.find(
+        match_electricity["$match"],
+        {"_id": 0, "asset_id": 1, "timestamp": 1, "value": 1}
+    )
+    .sort("value", -1)                                # Highest first
+    .limit(1)                                         # Take only top 1
+    .hint([("value_type", 1), ("value", -1)])
+)
 
-result_spike = list(db.telemetry.aggregate(pipeline_spike))
-print(result_spike)
+for doc in cursor_spike:
+    print(doc)
 
 
 
 # -----------------------------------------------------
 # 6️⃣ EMISSION CALCULATION (CARBON FOOTPRINT)
 # -----------------------------------------------------
-print("\n6️⃣ Total Emissions (kg CO₂):")
-# 1 kWh = 0.82 kg CO₂ (emission factor)
+print(f"\n6️⃣ Total Emissions (kg CO₂) {WINDOW}:")
+# kg CO₂ is precomputed per asset per day by refresh_rollups.py
+# (1 kWh = EMISSION_FACTOR kg CO₂), so this is a plain $sum over the rollup
 
 pipeline_emission = [
-    {"$match": {"value_type": "electricity_kWh"}},
+    {"$match": {"date": {"$gte": REPORT_START, "$lte": REPORT_END}}},
     {"$group": {
         "_id": None,
-        "total_kgCO2": {"$sum": {"$multiply": ["$value", 0.82]}}
+        "total_kgCO2": {"$sum": "$kgco2"}
     }}
 ]
 
-result_emission = list(db.telemetry.aggregate(pipeline_emission))
-print(result_emission)
+if db[ROLLUP_COLLECTION].estimated_document_count() == 0:
+    print(f"Rollup collection {ROLLUP_COLLECTION} is empty — run refresh_rollups.py first.")
+else:
+    print("(from the daily rollup; may lag raw telemetry until refresh_rollups.py is re-run)")
+    for doc in db[ROLLUP_COLLECTION].aggregate(pipeline_emission, batchSize=BATCH_SIZE):
+        print(doc)
 
 
 
@@ -128,16 +165,18 @@ pipeline_geo = [
         "$geoNear": {
             "near": {"type": "Point", "coordinates": [81.6296, 21.2514]},  # Your site's location
             "distanceField": "distance",
-            "spherical": True
+            "spherical": True,
+            "maxDistance": 100000                     # Only providers within 100 km
         }
-    }
+    },
+    {"$limit": 5}                                     # Nearest 5 are enough
 ]
 
-# NOTE: To run this query, ensure 2dsphere index is created on service_providers.location
+# NOTE: the 2dsphere index on service_providers.location is created by db_connect.get_db()
 
 try:
-    result_geo = list(db.service_providers.aggregate(pipeline_geo))
-    print(result_geo)
+    for doc in db.service_providers.aggregate(pipeline_geo):
+        print(doc)
 except Exception as e:
     print("GeoNear requires 2dsphere index!")
     print("Error:", e)
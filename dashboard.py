@@ -2,8 +2,11 @@
 # Streamlit dashboard for EcoTrack-Enterprise (MongoDB backend)
 # Put this file in your project folder and run: streamlit run dashboard.py
 
+import io
 import streamlit as st
-from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+import db_connect
+from refresh_rollups import ROLLUP_COLLECTION, refresh_rollups
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
@@ -23,93 +26,215 @@ st.set_page_config(page_title="EcoTrack Enterprise", layout="wide")
 # ------------------------
 @st.cache_resource
 def get_db():
-    client = MongoClient("mongodb://localhost:27017/")
-    return client["ecotrack"]
+    # reuse the process-wide pooled client across Streamlit reruns
+    return db_connect.get_db()
 
 db = get_db()
 
+# Query results are cached per (site, start, end). Keep the TTL no shorter than the
+# rollup refresh cadence — re-querying faster than the rollup changes gains nothing
+CACHE_TTL = 300
+# Forecast caches key on the whole series, so every site / range / horizon adds an
+# entry; cap them so a long-running dashboard does not grow without bound
+FORECAST_CACHE_ENTRIES = 32
+
 # ------------------------
 # Utility functions
 # ------------------------
-def create_2dsphere_index():
-    """Create 2dsphere index on service_providers.location if not exists."""
+def rebuild_2dsphere_index():
+    """Drop and recreate the 2dsphere index on service_providers.location."""
     coll = db.service_providers
-    # check existing indexes quickly
-    indexes = coll.index_information()
-    for name, info in indexes.items():
-        keys = info.get("key", [])
-        for key in keys:
-            if key[0] == "location":
-                return "2dsphere index already exists"
+    try:
+        coll.drop_index("location_2dsphere")
+    except OperationFailure:
+        pass  # index did not exist yet
     coll.create_index([("location", "2dsphere")])
-    return "2dsphere index created"
+    return "2dsphere index rebuilt"
 
 def load_sites():
-    sites = list(db.sites.find({}, {"_id": 0, "site_id": 1, "name": 1}))
+    sites = list(db.sites.find({}, {"_id": 0, "site_id": 1, "name": 1, "location": 1}))
     if not sites:
         return []
     return sites
 
-def telemetry_df(site_id=None, start=None, end=None):
+# MongoDB error codes for "$geoNear requires a 2d or 2dsphere index" (IndexNotFound)
+# and the older "unable to find index for $geoNear query" (NoQueryExecutionPlans)
+MISSING_GEO_INDEX = (27, 291)
+
+def load_providers(center=None, max_distance=100000, limit=20):
     """
-    Returns telemetry as pandas DataFrame filtered by site_id and date range.
-    Assumes telemetry documents have timestamp (ISO string), asset_id, value_type, value.
+    Service providers nearest to center (GeoJSON point) within max_distance metres,
+    with location.coordinates flattened server-side into lat/lon.
+    Falls back to the unfiltered, limited list if the 2dsphere index is missing.
     """
-    q = {}
+    flatten = [
+        {"$project": {
+            "_id": 0,
+            "name": {"$ifNull": ["$name", ""]},
+            "type": {"$ifNull": ["$type", ""]},
+            # streamlit map expects lat/lon; GeoJSON stores [lon, lat]
+            "lat": {"$arrayElemAt": ["$location.coordinates", 1]},
+            "lon": {"$arrayElemAt": ["$location.coordinates", 0]}
+        }},
+        {"$match": {"lat": {"$ne": None}, "lon": {"$ne": None}}},
+        {"$limit": limit}
+    ]
+    if center:
+        geo_near = {"$geoNear": {
+            "near": center,
+            "distanceField": "distance",
+            "maxDistance": max_distance,
+            "spherical": True
+        }}
+        try:
+            return list(db.service_providers.aggregate([geo_near] + flatten))
+        except OperationFailure as e:
+            # $geoNear needs the 2dsphere index, which may be missing or mid-rebuild;
+            # anything else (auth, bad near point, ...) must surface
+            if e.code not in MISSING_GEO_INDEX:
+                raise
+    return list(db.service_providers.aggregate(flatten))
+
+TELEMETRY_COLUMNS = ["asset_id", "value_type", "value", "timestamp"]
+
+def telemetry_query(site_id=None, start=None, end=None):
+    """Builds the electricity telemetry filter for a site_id and date range."""
+    # value_type is always set so both the all-sites and per-site filters
+    # match an index prefix (vt_ts_aid_v / site_vt_ts_aid_v)
+    q = {"value_type": "electricity_kWh"}
     if site_id and site_id != "All":
-        # first find asset_ids for site
-        asset_ids = [a["asset_id"] for a in db.assets.find({"site_id": site_id}, {"asset_id": 1})]
-        q["asset_id"] = {"$in": asset_ids} if asset_ids else {"$exists": False}
+        # telemetry carries site_id, so no asset lookup is needed
+        q["site_id"] = site_id
     if start or end:
-        # convert to strings in ISO if needed
         q["timestamp"] = {}
         if start:
-            q["timestamp"]["$gte"] = start.strftime("%Y-%m-%dT%H:%M:%S")
+            q["timestamp"]["$gte"] = start
         if end:
-            q["timestamp"]["$lte"] = end.strftime("%Y-%m-%dT%H:%M:%S")
+            q["timestamp"]["$lte"] = end
         if not q["timestamp"]:
             q.pop("timestamp")
+    return q
 
-    cursor = db.telemetry.find(q)
-    rows = list(cursor)
-    if not rows:
-        return pd.DataFrame()
-    df = pd.DataFrame(rows)
-    # ensure timestamp is datetime
-    if "timestamp" in df.columns:
-        try:
-            df["ts"] = pd.to_datetime(df["timestamp"])
-        except Exception:
-            # if already datetime-like, keep
-            df["ts"] = pd.to_datetime(df["timestamp"], errors="coerce")
-    else:
-        df["ts"] = pd.NaT
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def telemetry_df(site_id=None, start=None, end=None):
+    """
+    Returns telemetry as pandas DataFrame filtered by site_id and date range.
+    Assumes telemetry documents have timestamp (BSON date), asset_id, value_type, value.
+    """
+    q = telemetry_query(site_id, start, end)
+    projection = {"_id": 0, "asset_id": 1, "value_type": 1, "value": 1, "timestamp": 1}
+    cursor = db.telemetry.find(q, projection).batch_size(5000)
+    # hand the cursor straight to pandas instead of building our own list first
+    df = pd.DataFrame.from_records(cursor, columns=TELEMETRY_COLUMNS)
+    # timestamps are stored as BSON dates, so they arrive as datetimes — no parsing
+    df["ts"] = df["timestamp"]
     return df
 
-def calc_total_kwh(df):
-    if df.empty:
-        return 0.0
-    return float(df[df["value_type"] == "electricity_kWh"]["value"].sum())
+def rollup_query(site_id=None, start=None, end=None):
+    """Builds the $match filter for the daily rollup collection."""
+    q = {}
+    if site_id and site_id != "All":
+        q["site_id"] = site_id
+    if start or end:
+        q["date"] = {}
+        if start:
+            q["date"]["$gte"] = start
+        if end:
+            q["date"]["$lte"] = end
+    return q
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def compute_dashboard(site_id=None, start=None, end=None):
+    """
+    Computes all KPI / chart inputs in one $facet round trip over the daily rollup.
+    Returns a dict with total_kwh, emissions_kg, avg_kwh, points, daily (date, daily_kWh),
+    by_asset (top 10 asset_id, total_kWh) and rollup_ready (False until the rollup is built).
+    """
+    result = list(db[ROLLUP_COLLECTION].aggregate([
+        {"$match": rollup_query(site_id, start, end)},
+        {"$facet": {
+            "totals": [
+                {"$group": {
+                    "_id": None,
+                    "sum": {"$sum": "$sum_kwh"},
+                    "n": {"$sum": "$count"},
+                    "kgco2": {"$sum": "$kgco2"}
+                }}
+            ],
+            "daily": [
+                {"$group": {"_id": "$date", "daily_kWh": {"$sum": "$sum_kwh"}}},
+                {"$sort": {"_id": 1}}
+            ],
+            "by_asset": [
+                {"$group": {"_id": "$asset_id", "total_kWh": {"$sum": "$sum_kwh"}}},
+                {"$sort": {"total_kWh": -1}},
+                {"$limit": 10}
+            ]
+        }}
+    ], allowDiskUse=False))[0]
 
-def calc_emissions_kg(total_kwh, factor=0.82):
-    return total_kwh * factor
+    totals = result["totals"][0] if result["totals"] else {"sum": 0.0, "n": 0, "kgco2": 0.0}
+    daily = pd.DataFrame(result["daily"], columns=["_id", "daily_kWh"]).rename(columns={"_id": "date"})
+    daily["date"] = pd.to_datetime(daily["date"])
+    by_asset = pd.DataFrame(result["by_asset"], columns=["_id", "total_kWh"]).rename(columns={"_id": "asset_id"})
+    return {
+        "total_kwh": float(totals["sum"]),
+        "emissions_kg": float(totals["kgco2"]),
+        "avg_kwh": float(totals["sum"]) / totals["n"] if totals["n"] else 0.0,
+        "points": int(totals["n"]),
+        "daily": daily,
+        "by_asset": by_asset,
+        "rollup_ready": db[ROLLUP_COLLECTION].estimated_document_count() > 0,
+    }
 
-def daily_aggregates(df):
-    if df.empty:
-        return pd.DataFrame(columns=["date", "daily_kWh"])
-    d = df[df["value_type"] == "electricity_kWh"].copy()
-    d["date"] = d["ts"].dt.date
-    agg = d.groupby("date")["value"].sum().reset_index().rename(columns={"value": "daily_kWh"})
-    agg["date"] = pd.to_datetime(agg["date"])
-    return agg.sort_values("date")
-
-def asset_aggregates(df):
+# MongoDB error code for "Unrecognized pipeline stage name"
+UNRECOGNIZED_PIPELINE_STAGE = 40324
+
+def zscore_anomalies(df, threshold=2.5):
+    """Vectorized per-asset z-score over a telemetry DataFrame (client-side fallback)."""
     if df.empty:
-        return pd.DataFrame(columns=["asset_id", "total_kWh"])
-    d = df[df["value_type"] == "electricity_kWh"].copy()
-    agg = d.groupby("asset_id")["value"].sum().reset_index().rename(columns={"value": "total_kWh"})
-    return agg.sort_values("total_kWh", ascending=False)
+        return pd.DataFrame(columns=["asset_id", "timestamp", "value", "z"])
+    z_df = df[df["value_type"]=="electricity_kWh"].copy()
+    g = z_df.groupby("asset_id")["value"]
+    mean = g.transform("mean")
+    std = g.transform("std", ddof=0).replace(0, 1)
+    z_df["z"] = (z_df["value"] - mean) / std
+    return z_df[z_df["z"] > threshold][["asset_id", "timestamp", "value", "z"]]
 
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def detect_anomalies(site_id=None, start=None, end=None, threshold=2.5):
+    """
+    Per-asset z-score anomaly detection done server-side: $setWindowFields computes
+    each asset's mean/std in one pass and only readings with z > threshold come back.
+    Falls back to zscore_anomalies only on servers that reject $setWindowFields.
+    """
+    q = telemetry_query(site_id, start, end)
+    try:
+        rows = list(db.telemetry.aggregate([
+            {"$match": q},
+            {"$setWindowFields": {
+                "partitionBy": "$asset_id",
+                "output": {
+                    "mean": {"$avg": "$value"},
+                    "std": {"$stdDevPop": "$value"}
+                }
+            }},
+            {"$addFields": {"z": {"$divide": [
+                {"$subtract": ["$value", "$mean"]},
+                {"$cond": [{"$gt": ["$std", 0]}, "$std", 1]}
+            ]}}},
+            {"$match": {"z": {"$gt": threshold}}},
+            {"$project": {"_id": 0, "asset_id": 1, "timestamp": 1, "value": 1, "z": 1}}
+        ]))
+    except OperationFailure as e:
+        # only fall back when the server does not know $setWindowFields (Mongo-compatible
+        # servers without window functions); auth / memory-limit errors must surface
+        if e.code != UNRECOGNIZED_PIPELINE_STAGE:
+            raise
+        return zscore_anomalies(telemetry_df(site_id, start, end), threshold)
+    return pd.DataFrame(rows, columns=["asset_id", "timestamp", "value", "z"])
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=FORECAST_CACHE_ENTRIES, show_spinner=False)
 def simple_moving_average_forecast(series, days_out=7, window=3):
     # series: pandas Series indexed by date
     if series.empty:
@@ -117,8 +242,8 @@ def simple_moving_average_forecast(series, days_out=7, window=3):
     ma = series.rolling(window=window, min_periods=1).mean()
     last = ma.iloc[-1]
     # naive forecast: repeat last moving average for next days
-    future_idx = pd.date_range(start=series.index[-1] + pd.Timedelta(days=1), periods=days_out)
-    return pd.Series([last]*days_out, index=future_idx)
+    future_idx = pd.date_range(start=series.index[-1] + pd.Timedelta(days=1), periods=days_out, freq="D")
+    return pd.Series(np.full(days_out, last, dtype=np.float64), index=future_idx)
 
 def prophet_forecast(series, days_out=14):
     """Run Prophet if available. Input: series indexed by date (pd.Series)."""
@@ -132,6 +257,20 @@ def prophet_forecast(series, days_out=14):
     # return forecast for last days_out
     return forecast[["ds", "yhat"]].set_index("ds")["yhat"].iloc[-days_out:]
 
+@st.cache_data(ttl=CACHE_TTL, max_entries=FORECAST_CACHE_ENTRIES, show_spinner=False)
+def forecast_plot_png(series, forecast, label):
+    """Renders actual + forecast to PNG bytes; cached so unchanged series skip re-plotting."""
+    fig, ax = plt.subplots(figsize=(6,3))
+    ax.plot(series.index, series.values, label="Actual")
+    ax.plot(forecast.index, forecast.values, label=label)
+    ax.legend()
+    ax.set_xlabel("Date")
+    ax.set_ylabel("kWh")
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", bbox_inches="tight")
+    plt.close(fig)
+    return buf.getvalue()
+
 # ------------------------
 # Streamlit UI
 # ------------------------
@@ -146,6 +285,7 @@ with st.sidebar:
     chosen_site_name = st.selectbox("Select Site", site_options)
     # map site name to site_id
     site_map = {s["name"]: s["site_id"] for s in sites}
+    site_locations = {s["site_id"]: s.get("location") for s in sites}
     chosen_site_id = site_map.get(chosen_site_name, "All")
 
     today = datetime.now()
@@ -154,9 +294,15 @@ with st.sidebar:
     end_date = st.date_input("End date", today)
     st.write(" ")
     st.subheader("Geo / Index")
-    if st.button("Create 2dsphere index on service_providers"):
-        msg = create_2dsphere_index()
+    if st.button("Rebuild 2dsphere index on service_providers"):
+        msg = rebuild_2dsphere_index()
         st.success(msg)
+    st.subheader("Rollups")
+    if st.button("Refresh daily rollups"):
+        with st.spinner("Rebuilding rollups..."):
+            name = refresh_rollups(db)
+            compute_dashboard.clear()
+        st.success(f"Rollups refreshed into {name}")
 
     st.write(" ")
     st.markdown("---")
@@ -170,20 +316,19 @@ with st.sidebar:
 # Load telemetry per filters
 start_dt = datetime.combine(start_date, datetime.min.time())
 end_dt = datetime.combine(end_date, datetime.max.time())
-df = telemetry_df(site_id=chosen_site_id if chosen_site_id!="All" else None, start=start_dt, end=end_dt)
+site_filter = chosen_site_id if chosen_site_id!="All" else None
 
 # Top KPIs
+kpis = compute_dashboard(site_id=site_filter, start=start_dt, end=end_dt)
+if not kpis["rollup_ready"]:
+    st.warning("Daily rollups have not been built yet, so KPIs and charts are empty. "
+               "Click \"Refresh daily rollups\" in the sidebar (or run refresh_rollups.py).")
 col1, col2, col3, col4 = st.columns(4)
-total_kwh = calc_total_kwh(df)
-emissions = calc_emissions_kg(total_kwh)
-avg_kwh = 0.0
-if not df.empty:
-    avg_kwh = float(df[df["value_type"]=="electricity_kWh"]["value"].mean())
 
-col1.metric("Total electricity (kWh)", f"{total_kwh:.2f}")
-col2.metric("Total emissions (kg CO₂)", f"{emissions:.2f}")
-col3.metric("Average reading (kWh)", f"{avg_kwh:.2f}")
-col4.metric("Telemetry points", len(df))
+col1.metric("Total electricity (kWh)", f"{kpis['total_kwh']:.2f}")
+col2.metric("Total emissions (kg CO₂)", f"{kpis['emissions_kg']:.2f}")
+col3.metric("Average reading (kWh)", f"{kpis['avg_kwh']:.2f}")
+col4.metric("Telemetry points", kpis["points"])
 
 st.markdown("---")
 
@@ -192,8 +337,10 @@ left, right = st.columns([2,1])
 
 with left:
     st.subheader("Daily Electricity Usage")
-    daily = daily_aggregates(df)
-    if daily.empty:
+    daily = kpis["daily"]
+    if not kpis["rollup_ready"]:
+        st.info("Waiting for the daily rollup — see the warning above.")
+    elif daily.empty:
         st.info("No electricity telemetry found for the selected filters.")
     else:
         # line chart
@@ -201,44 +348,20 @@ with left:
         st.line_chart(chart_df)
 
     st.subheader("Asset-wise Usage (Top 10)")
-    asset_df = asset_aggregates(df)
+    asset_df = kpis["by_asset"]
     if asset_df.empty:
         st.info("No asset data")
     else:
-        top10 = asset_df.head(10).set_index("asset_id")["total_kWh"]
+        top10 = asset_df.set_index("asset_id")["total_kWh"]
         st.bar_chart(top10)
 
     st.subheader("Highest Spikes / Anomalies (Simple)")
-    if df.empty:
-        st.write("No data to analyze anomalies.")
+    # simple z-score anomaly detection per asset
+    anomalies = detect_anomalies(site_id=site_filter, start=start_dt, end=end_dt)
+    if anomalies.empty:
+        st.write("No strong anomalies detected (z>2.5).")
     else:
-        # simple z-score anomaly detection per asset
-        from sklearn.preprocessing import StandardScaler
-        z_df = df[df["value_type"]=="electricity_kWh"].copy()
-        if z_df.empty:
-            st.write("No electricity data")
-        else:
-            grouped = z_df.groupby("asset_id")
-            anomaly_records = []
-            for aid, g in grouped:
-                arr = g["value"].values
-                if len(arr) < 2:
-                    continue
-                mean = arr.mean()
-                std = arr.std(ddof=0) if arr.std(ddof=0) > 0 else 1.0
-                # mark datapoints with z > 2.5
-                mask = (g["value"] - mean) / std > 2.5
-                for idx, val in g[mask].iterrows():
-                    anomaly_records.append({
-                        "asset_id": aid,
-                        "timestamp": val["timestamp"],
-                        "value": val["value"],
-                        "z": (val["value"]-mean)/std
-                    })
-            if anomaly_records:
-                st.table(pd.DataFrame(anomaly_records))
-            else:
-                st.write("No strong anomalies detected (z>2.5).")
+        st.table(anomalies)
 
 with right:
     st.subheader("Forecast")
@@ -255,48 +378,23 @@ with right:
             try:
                 with st.spinner("Running Prophet..."):
                     forecast_series = prophet_forecast(series, days_out=days_out)
-                    last_index = series.index[-1]
-                    # plot combined
-                    combined = pd.concat([series, forecast_series.rename("yhat")])
-                    fig, ax = plt.subplots(figsize=(6,3))
-                    ax.plot(series.index, series.values, label="Actual")
-                    ax.plot(forecast_series.index, forecast_series.values, label="Prophet Forecast")
-                    ax.legend()
-                    ax.set_xlabel("Date")
-                    ax.set_ylabel("kWh")
-                    st.pyplot(fig)
+                    st.image(forecast_plot_png(series, forecast_series, "Prophet Forecast"))
             except Exception as e:
                 st.error("Prophet error: " + str(e))
         else:
             # moving average forecast
             wa = simple_moving_average_forecast(series, days_out=days_out, window=3)
-            fig, ax = plt.subplots(figsize=(6,3))
-            ax.plot(series.index, series.values, label="Actual")
-            ax.plot(wa.index, wa.values, label=f"{len(wa)}-day MA Forecast")
-            ax.legend()
-            ax.set_xlabel("Date")
-            ax.set_ylabel("kWh")
-            st.pyplot(fig)
+            st.image(forecast_plot_png(series, wa, f"{len(wa)}-day MA Forecast"))
 
     st.subheader("Nearest Service Providers (Map)")
     # Map of service providers
-    provs = list(db.service_providers.find({}, {"_id":0, "name":1, "type":1, "location":1}))
+    provs = load_providers(center=site_locations.get(chosen_site_id))
     if not provs:
-        st.info("No service providers found in DB.")
+        st.info("No service providers with valid coordinates found.")
     else:
-        rows = []
-        for p in provs:
-            loc = p.get("location", {})
-            coords = loc.get("coordinates") if loc else None
-            if coords and isinstance(coords, list) and len(coords) >= 2:
-                # streamlit map expects [lat, lon] in dataframe
-                rows.append({"name": p.get("name", ""), "type": p.get("type",""), "lat": coords[1], "lon": coords[0]})
-        if rows:
-            prov_df = pd.DataFrame(rows)
-            st.map(prov_df.rename(columns={"lat":"lat","lon":"lon"})[["lat","lon"]])
-            st.table(prov_df[["name","type"]].head(10))
-        else:
-            st.info("Service provider locations invalid or missing coordinates.")
+        prov_df = pd.DataFrame(provs)
+        st.map(prov_df[["lat","lon"]])
+        st.table(prov_df[["name","type"]].head(10))
 
 st.markdown("---")
 st.caption("Built for EcoTrack-Enterprise — MongoDB based sustainability intelligence demo.")
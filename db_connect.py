@@ -1,8 +1,54 @@
+import os
 from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+
+MONGODB_URI = os.environ.get("MONGODB_URI", "mongodb://localhost:27017/")
+DB_NAME = "ecotrack"
+
+_client = None
+_indexes_ready = False
+
+def get_client():
+    # One pooled client per process, created on first use and shared by every caller
+    global _client
+    if _client is None:
+        _client = MongoClient(
+            MONGODB_URI,
+            maxPoolSize=50,
+            minPoolSize=5,
+            serverSelectionTimeoutMS=3000,
+            connectTimeoutMS=3000
+        )
+    return _client
+
+def ensure_indexes(db):
+    # Compound index backing the electricity pipelines: value_type equality,
+    # timestamp range, then asset_id/value so $group can be served from the index
+    db.telemetry.create_index(
+        [("value_type", 1), ("timestamp", 1), ("asset_id", 1), ("value", 1)],
+        name="vt_ts_aid_v"
+    )
+    # Site-filtered dashboard reads: site_id / value_type equality, timestamp range,
+    # plus asset_id/value so the projected telemetry_df query is covered
+    db.telemetry.create_index(
+        [("site_id", 1), ("value_type", 1), ("timestamp", 1), ("asset_id", 1), ("value", 1)],
+        name="site_vt_ts_aid_v"
+    )
+    # Highest-spike lookup: walk value descending within one value_type
+    db.telemetry.create_index([("value_type", 1), ("value", -1)], name="vt_value")
+    # $geoNear on service providers needs this; create_index is a no-op if it exists
+    try:
+        db.service_providers.create_index([("location", "2dsphere")])
+    except OperationFailure:
+        # e.g. a provider document with malformed GeoJSON — geo queries will report it
+        pass
 
 def get_db():
-    client = MongoClient("mongodb://localhost:27017/")
-    db = client["ecotrack"]
+    global _indexes_ready
+    db = get_client()[DB_NAME]
+    if not _indexes_ready:
+        ensure_indexes(db)
+        _indexes_ready = True
     return db
 
 # Test
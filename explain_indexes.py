@@ -0,0 +1,57 @@
+# -----------------------------------------------------
+#  explain_indexes.py
+#  Dev check: the filters built by dashboard.telemetry_query
+#  (all sites and per site, always with value_type) must be
+#  answered by an index scan, never a COLLSCAN.
+#      python explain_indexes.py
+# -----------------------------------------------------
+
+from datetime import datetime
+from db_connect import get_db
+
+db = get_db()
+
+START = datetime(2024, 1, 1)
+END = datetime(2024, 1, 14, 23, 59, 59)
+PROJECTION = {"_id": 0, "asset_id": 1, "value_type": 1, "value": 1, "timestamp": 1}
+
+# Mirrors dashboard.telemetry_query — keep the two in sync
+QUERIES = {
+    "site + date range": {
+        "site_id": 1,
+        "value_type": "electricity_kWh",
+        "timestamp": {"$gte": START, "$lte": END}
+    },
+    "all sites + date range": {
+        "value_type": "electricity_kWh",
+        "timestamp": {"$gte": START, "$lte": END}
+    },
+}
+
+
+def plan_stages(plan):
+    # Walk the winning plan tree and collect stage names, root first
+    stages = [plan["stage"]]
+    children = plan.get("inputStages", [])
+    if "inputStage" in plan:
+        children = [plan["inputStage"]]
+    for child in children:
+        stages += plan_stages(child)
+    return stages
+
+
+for name, q in QUERIES.items():
+    explain = db.command(
+        "explain",
+        {"find": "telemetry", "filter": q, "projection": PROJECTION},
+        verbosity="executionStats"
+    )
+    winning = explain["queryPlanner"]["winningPlan"]
+    winning = winning.get("queryPlan", winning)       # slot-based engine nests the plan
+    stages = plan_stages(winning)
+    stats = explain["executionStats"]
+
+    assert "COLLSCAN" not in stages, f"{name}: collection scan ({stages})"
+    assert "IXSCAN" in stages, f"{name}: no index scan ({stages})"
+    print(f"{name}: {' <- '.join(stages)} | "
+          f"keys examined {stats['totalKeysExamined']}, docs examined {stats['totalDocsExamined']}")
@@ -1,19 +1,24 @@
+import sys
 from db_connect import get_db
 
 db = get_db()
 
+# Only print a sample of each collection unless a full dump is asked for
+FULL_DUMP = "--all" in sys.argv
+LIMIT = 0 if FULL_DUMP else 20       # limit(0) means no limit
+
 print("\n----- SITES -----")
 for site in db.sites.find():
     print(site)
 
 print("\n----- ASSETS -----")
-for asset in db.assets.find():
+for asset in db.assets.find({}, {"_id": 0}).limit(LIMIT):
     print(asset)
 
 print("\n----- TELEMETRY -----")
-for t in db.telemetry.find():
+for t in db.telemetry.find({}, {"_id": 0, "asset_id": 1, "timestamp": 1, "value": 1}).sort("timestamp", -1).limit(LIMIT):
     print(t)
 
 print("\n----- ALERTS -----")
-for alert in db.alerts.find():
+for alert in db.alerts.find({}, {"_id": 0, "alert_id": 1, "asset_id": 1, "timestamp": 1, "value": 1}).sort("timestamp", -1).limit(LIMIT):
     print(alert)
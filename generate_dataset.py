@@ -1,10 +1,11 @@
-import json, csv, random
+import json, csv, random, sys
 from datetime import datetime, timedelta
+import numpy as np
+from db_connect import get_db
 
 # ---------- OUTPUT FILES ----------
 SITES_FILE = "sites.json"
 ASSETS_FILE = "assets.json"
-TELEMETRY_FILE = "telemetry.csv"
 WASTE_FILE = "waste_logs.csv"
 SP_FILE = "service_providers.json"
 ALERTS_FILE = "alerts.json"
@@ -35,50 +36,70 @@ with open(ASSETS_FILE, "w") as f:
 start = datetime(2024,1,1,0,0,0)
 end = datetime(2024,12,31,23,0,0)
 
-hours = int((end - start).total_seconds()/3600)
-rows = []
-
-current = start
-
-while current <= end:
-    for a in assets:
-        base = {
-            "electricity_meter": 20,
-            "machine": 8,
-            "compressor": 6,
-            "solar_panel": 3,
-            "forklift": 5
-        }.get(a["type"], 6)
-
-        # realistic variations
-        value = round(base + random.uniform(-2, 3), 2)
-
-        rows.append([
-            current.isoformat(),
-            a["asset_id"],
-            a["site_id"],
-            "electricity_kWh",
-            value
-        ])
-
-    current += timedelta(hours=1)
-
-with open(TELEMETRY_FILE, "w", newline="") as f:
-    writer = csv.writer(f)
-    writer.writerow(["timestamp","asset_id","site_id","value_type","value"])
-    writer.writerows(rows)
+n_hours = int((end - start).total_seconds()//3600) + 1
+BATCH_SIZE = 1000
+
+base_map = {
+    "electricity_meter": 20,
+    "machine": 8,
+    "compressor": 6,
+    "solar_panel": 3,
+    "forklift": 5
+}
+
+# whole (hours x assets) value matrix in one call, with realistic variations
+bases = np.array([base_map.get(a["type"], 6) for a in assets])
+values = np.round(bases[None, :] + np.random.uniform(-2, 3, size=(n_hours, len(assets))), 2).tolist()
+times = [start + timedelta(hours=i) for i in range(n_hours)]
+
+# load straight into MongoDB so timestamps keep their datetime type
+db = get_db()
+
+# existing telemetry is only wiped when asked for explicitly
+if "--reset" in sys.argv:
+    deleted = db.telemetry.delete_many({}).deleted_count
+    print(f"--reset: deleted {deleted} telemetry documents from {db.name}.telemetry")
+else:
+    # there is no unique key on readings, so a second load would double every total
+    if db.telemetry.find_one({"timestamp": {"$gte": start, "$lte": end}}, {"_id": 1}):
+        sys.exit(f"{db.name}.telemetry already has readings between {start} and {end}; "
+                 "re-run with --reset to replace them.")
+    if db.telemetry.find_one({"timestamp": {"$type": "string"}}, {"_id": 1}):
+        sys.exit(f"{db.name}.telemetry has string timestamps from the old CSV import; "
+                 "run migrate_timestamps.py first, or re-run with --reset.")
+
+batch = []
+for current, hour_values in zip(times, values):
+    for a, value in zip(assets, hour_values):
+        batch.append({
+            "timestamp": current,          # stored as BSON Date, not an ISO string
+            "asset_id": a["asset_id"],
+            "site_id": a["site_id"],
+            "value_type": "electricity_kWh",
+            "value": value
+        })
+
+        # unordered bulk inserts in fixed-size chunks
+        if len(batch) >= BATCH_SIZE:
+            db.telemetry.insert_many(batch, ordered=False)
+            batch = []
+
+if batch:
+    db.telemetry.insert_many(batch, ordered=False)
 
 # ---------- WASTE LOGS ----------
 waste = []
 waste_types = ["plastic","metal","organic","hazardous"]
+waste_kinds = np.random.choice(waste_types, 365).tolist()
+waste_qty = np.random.uniform(50, 200, 365).round(2).tolist()
 
 d = datetime(2024,1,1)
-for i in range(365):
+for kind, qty in zip(waste_kinds, waste_qty):
     waste.append({
         "site_id": 1,
         "date": d.strftime("%Y-%m-%d"),
-        "type": random.choice(waste_types),
-        "quantity_kg": round(random.uniform(50,200),2)
+        "type": kind,
+        "quantity_kg": qty
     })
     d += timedelta(days=1)
 
@@ -0,0 +1,17 @@
+# -----------------------------------------------------
+#  migrate_timestamps.py
+#  One-time migration for databases loaded from the old
+#  telemetry.csv import, where timestamp is an ISO string.
+#  Converts those timestamps to BSON dates in place:
+#      python migrate_timestamps.py
+# -----------------------------------------------------
+
+from db_connect import get_db
+
+db = get_db()
+
+result = db.telemetry.update_many(
+    {"timestamp": {"$type": "string"}},
+    [{"$set": {"timestamp": {"$toDate": "$timestamp"}}}]
+)
+print(f"Converted {result.modified_count} string timestamps to dates in {db.name}.telemetry")
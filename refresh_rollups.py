@@ -0,0 +1,75 @@
+# -----------------------------------------------------
+#  refresh_rollups.py
+#  Rebuilds the daily telemetry rollup (one document per
+#  asset per day) that the dashboard reads instead of raw
+#  telemetry. Run after loading data, or on a schedule:
+#      python refresh_rollups.py
+# -----------------------------------------------------
+
+import hashlib
+import json
+import os
+
+from db_connect import get_db
+
+# kg CO2 per kWh, applied once per refresh instead of on every emissions query
+EMISSION_FACTOR = float(os.environ.get("EMISSION_FACTOR", 0.82))
+
+
+def rollup_pipeline(emission_factor):
+    return [
+        # $dateTrunc fails on strings — skip any not yet run through migrate_timestamps.py
+        {"$match": {"value_type": "electricity_kWh", "timestamp": {"$type": "date"}}},
+        {"$group": {
+            "_id": {
+                "date": {"$dateTrunc": {"date": "$timestamp", "unit": "day"}},
+                "asset_id": "$asset_id"
+            },
+            "site_id": {"$first": "$site_id"},
+            "sum_kwh": {"$sum": "$value"},
+            "count": {"$sum": 1},
+            "sum_sq": {"$sum": {"$multiply": ["$value", "$value"]}},
+            "kgco2": {"$sum": {"$multiply": ["$value", emission_factor]}}
+        }},
+        {"$set": {"date": "$_id.date", "asset_id": "$_id.asset_id"}}
+    ]
+
+
+ROLLUP_PIPELINE = rollup_pipeline(EMISSION_FACTOR)
+
+
+def rollup_collection_name():
+    # Name the collection after a hash of the pipeline shape, so changing the
+    # rollup definition writes to a fresh collection instead of mixing shapes.
+    # The emission factor is hashed as a placeholder: processes started with a
+    # different EMISSION_FACTOR must still read and write the same collection.
+    shape = rollup_pipeline("EMISSION_FACTOR")
+    digest = hashlib.sha1(json.dumps(shape, sort_keys=True).encode()).hexdigest()
+    return "telemetry_daily_rollup_" + digest[:8]
+
+
+ROLLUP_COLLECTION = rollup_collection_name()
+
+
+def refresh_rollups(db=None):
+    """
+    Rebuild ROLLUP_COLLECTION from raw telemetry with $out and drop rollups
+    left behind by earlier pipeline versions.
+    """
+    if db is None:
+        db = get_db()
+    # $out swaps in the new collection atomically, so (date, asset) rows whose
+    # telemetry has since been deleted disappear instead of lingering
+    db.telemetry.aggregate(ROLLUP_PIPELINE + [{"$out": ROLLUP_COLLECTION}], allowDiskUse=True)
+    db[ROLLUP_COLLECTION].create_index([("date", 1), ("site_id", 1)])
+
+    stale = db.list_collection_names(filter={"name": {"$regex": "^telemetry_daily_rollup_"}})
+    for name in stale:
+        if name != ROLLUP_COLLECTION:
+            db.drop_collection(name)
+    return ROLLUP_COLLECTION
+
+
+if __name__ == "__main__":
+    name = refresh_rollups()
+    print("Rollups refreshed into", name)